@@ -19,6 +19,9 @@ import sqlite3
 import binascii
 from multiprocessing import Pool
 import argparse
+import re
+import os
+from urllib.request import pathname2url
 
 
 ids = dict()
@@ -27,16 +30,12 @@ ids = dict()
 # Functions used for converting IDs between the various formats. See load_ids
 # convert_ancestor_id: regroup bytes to convert from/to ancestor id format (symetric)
 def convert_ancestor_id(id: str):
-    # Group by bytes
-    id = [id[i : i+2] for i in range(0, len(id), 2)]
-
-    # Reorder (not sure why it's done like this but it is)
-    # and convert back to string.
+    # Reorder the bytes (2 hex digits each) in the order 3, 2, 1, 0, 5, 4, 7, 6
+    # (not sure why it's done like this but it is).
     # Note that only the first 8 bytes are rearranged, the others remain.
-    byte_order = (3, 2, 1, 0, 5, 4, 7, 6)
-    swapped_id = [id[i] for i in byte_order]
-    swapped_id.extend(id[8:])
-    return "".join(swapped_id)
+    return id[6:8] + id[4:6] + id[2:4] + id[0:2] + id[10:12] + id[8:10] + id[14:16] + id[12:14] + id[16:]
+# convert_ancestor_bin: same as convert_ancestor_id, but for binary ids (no hex round-trip)
+def convert_ancestor_bin(id: bytes): return id[3::-1] + id[5:3:-1] + id[7:5:-1] + id[8:]
 # bid2sid: binary id to string id
 def bid2sid(id): return binascii.b2a_hex(id).decode("ascii")
 # sid2bid: string id to binary id
@@ -45,6 +44,17 @@ def sid2bid(id): return binascii.a2b_hex(id)
 def sid2did(id): return "-".join([id[:8], id[8:12], id[12:16], id[16:20], id[20:]])
 
 
+# Opens a sqlite database read-only (not to be confused with open_db of jellyfin_migrator.py
+# which imports everything from here). The scanner only ever runs full table scans, hence the
+# large page cache and memory map. The journal mode is left alone (read-only connection).
+def open_db_readonly(path_to_db):
+    con = sqlite3.connect("file:" + pathname2url(os.path.abspath(path_to_db)) + "?mode=ro", uri=True)
+    con.execute("PRAGMA temp_store=MEMORY")
+    con.execute("PRAGMA cache_size=-262144")
+    con.execute("PRAGMA mmap_size=268435456")
+    return con
+
+
 # Loads all IDs from jellyfins library.db file.
 # Additionally, it generates all the variants of each ID that may be used.
 # GUIDs of the following formats have been found / are assumed to exist:
@@ -60,41 +70,41 @@ def sid2did(id): return "-".join([id[:8], id[8:12], id[12:16], id[16:20], id[20:
 #   * in paths they're grouped in folders by the first two letters:
 #     '.../83/833addde992893e93d0572907f8b4cad/...'
 def load_ids(library_db:str):
-    con = sqlite3.connect(library_db)
+    ids = {k: [] for k in ("str", "str-dash", "ancestor-str", "ancestor-str-dash")}
+    byteids = {k: [] for k in ("bin", "str", "str-dash", "ancestor-bin", "ancestor-str", "ancestor-str-dash")}
+
+    # All variants of an ID are generated in one go, directly from the rows of the query.
+    con = open_db_readonly(library_db)
     cur = con.cursor()
-    id_replacements_bin = [x[0] for x in cur.execute("SELECT `guid` FROM `TypedBaseItems`")]
+    for (id_bin,) in cur.execute("SELECT `guid` FROM `TypedBaseItems`"):
+        id_ancestor_bin = convert_ancestor_bin(id_bin)
+        id_str = bid2sid(id_bin)
+        id_ancestor_str = bid2sid(id_ancestor_bin)
+        variants = (
+            ("str", id_str),
+            ("str-dash", sid2did(id_str)),
+            ("ancestor-str", id_ancestor_str),
+            ("ancestor-str-dash", sid2did(id_ancestor_str)),
+        )
+        byteids["bin"].append(id_bin)
+        byteids["ancestor-bin"].append(id_ancestor_bin)
+        for k, v in variants:
+            ids[k].append(v)
+            byteids[k].append(v.encode("ascii"))
     con.close()
 
-    id_str               = [bid2sid(k) for k in id_replacements_bin]
-    id_str_dash          = [sid2did(k) for k in id_str]
-    id_ancestor_str      = [convert_ancestor_id(k) for k in id_str]
-    id_ancestor_bin      = [sid2bid(k) for k in id_ancestor_str]
-    id_ancestor_str_dash = [sid2did(k) for k in id_ancestor_str]
-
-    ids = {
-        "bin": id_replacements_bin,
-        "str": id_str,
-        "str-dash": id_str_dash,
-        "ancestor-bin": id_ancestor_bin,
-        "ancestor-str": id_ancestor_str,
-        "ancestor-str-dash": id_ancestor_str_dash,
-    }
-
-    print(f"{len(id_replacements_bin)} IDs loaded from library.db")
-
-    byteids = dict()
-    for k, v in ids.items():
-        if "bin" in k:
-            byteids[k] = v
-        else:
-            byteids[k] = [s.encode("ascii") for s in v]
-    ids = {k: v for k, v in ids.items() if "bin" not in k}
+    print(f"{len(byteids['bin'])} IDs loaded from library.db")
+
     return ids, byteids
 
 
+# Escapes a table/column name for use within `...` in a query.
+def quote_name(name: str): return name.replace("`", "``")
+
+
 # Loads the name of all tables in a sqlite db file as well as each one's columns.
 def load_db_tables_columns(path_to_db):
-    con = sqlite3.connect(path_to_db)
+    con = open_db_readonly(path_to_db)
     cur = con.cursor()
 
     # Get all table names. The query will also return index stuff that isn't required. It's (mostly) filtered.
@@ -105,8 +115,9 @@ def load_db_tables_columns(path_to_db):
         and x[0][-6:-1].lower() != "index"
     ]
 
-    # For each table, get all column names.
-    table_info = {n: [x[0] for x in cur.execute(f"SELECT name FROM PRAGMA_TABLE_INFO('{n}')")] for n in table_names}
+    # For each table, get all column names. The table name is bound as parameter, hence
+    # it's always the same statement (prepared only once).
+    table_info = {n: [x[0] for x in cur.execute("SELECT name FROM PRAGMA_TABLE_INFO(?)", (n,))] for n in table_names}
 
     con.close()
 
@@ -117,14 +128,19 @@ def load_db_tables_columns(path_to_db):
 def load_all_rows(path_to_db):
     table_info = load_db_tables_columns(path_to_db)
 
-    con = sqlite3.connect(path_to_db)
+    con = open_db_readonly(path_to_db)
     cur = con.cursor()
 
     rows = []
 
     for table, columns in table_info.items():
         for column in columns:
-            col_values = {x[0] for x in cur.execute(f"SELECT `{column}` FROM `{table}`") if x[0]}
+            # Identifiers can't be bound as parameters. Escape any ` in the names instead.
+            query = f"SELECT `{quote_name(column)}` FROM `{quote_name(table)}`"
+            col_values = set()
+            for (value,) in cur.execute(query):
+                if value:
+                    col_values.add(value)
             if not col_values:
                 continue
             rows.append([table, column, col_values])
@@ -159,18 +175,17 @@ def check_bin_ids(job):
 def check_embedded_id_types(job):
     table, column, column_values, ids = job
     id_types = set()
-    check_for_next_type = False
+
+    # Merge the ID candidates of all entries, separately for pure and embedded entries.
+    # Then each ID type only needs one set intersection per column type.
+    candidates = dict()
+    for column_type, column_value in column_values:
+        candidates.setdefault(column_type, set()).update(column_value)
 
     for id_type, values in ids.items():
-        for value in values:
-            for column_type, column_value in column_values:
-                if value in column_value:
-                    id_types.add(f"{id_type} ({column_type})")
-                    check_for_next_type = True
-                if check_for_next_type:
-                    break
-            if check_for_next_type:
-                break
+        for column_type, column_value in candidates.items():
+            if not column_value.isdisjoint(values):
+                id_types.add(f"{id_type} ({column_type})")
     if id_types:
         result = table, column, id_types
         return result
@@ -179,20 +194,20 @@ def check_embedded_id_types(job):
 # Takes an arbitrary string or byte-string and returns a set with all the chunks
 # from it that could be an ID: sequences of >=32 hexadecimal digits
 # (plus the - symbol used in some ID formats).
+id_candidate_re       = re.compile("[0-9a-f-]{32,}")
+id_candidate_bytes_re = re.compile(b"[0-9a-f-]{32,}")
+id_chars_re           = re.compile("[0-9a-f -]*")  # spaces separate multiple pure IDs
 def get_id_candidates(s):
-    result = ""
-    if type(s) is bytes:
-        result = "".join(chr(c) if c in b"0123456789abcdef-" else " " for c in s)
-    elif type(s) is str:
-        result = "".join(c if c in "0123456789abcdef-" else " " for c in s)
-
+    result = set()
     # check if it's a pure id or an id embedded within other data.
+    # Byte-strings are never pure (the candidates are returned as normal strings).
     column_type = "embedded"
-    if result == s:
-        column_type = "pure"
-
-    result = result.split(" ")
-    result = {piece for piece in result if len(piece) >= 32}
+    if type(s) is bytes:
+        result = {piece.decode("ascii") for piece in id_candidate_bytes_re.findall(s)}
+    elif type(s) is str:
+        result = set(id_candidate_re.findall(s))
+        if id_chars_re.fullmatch(s):
+            column_type = "pure"
     return column_type, result
 
 
@@ -216,6 +231,8 @@ if __name__ == "__main__":
 
     print("Loading IDs from library.db")
     ids, byteids = load_ids(args.library_db)
+    # Only used for membership tests from here on.
+    ids = {k: set(v) for k, v in ids.items()}
 
     print("Loading db to scan")
     jobs = [row + [byteids] for row in load_all_rows(args.scan_db)]
@@ -225,19 +242,16 @@ if __name__ == "__main__":
     print("Scanning... This will take a while. Example: scanning a library.db file with 78k IDs "
           "and 1.2M entries took about 5 minutes.")
     results = []
+    # One pool of worker processes for all stages instead of starting a new one per column.
     with Pool() as p:
         results.extend(p.map(check_bin_ids, jobs, chunksize=64))
 
-    # Search through all values for ID occurences. to speed this up,
-    # remove anything that for sure doesn't match, like shorter items or non alphanum chars.
-    for i, job in enumerate(jobs):
-        col_values = job[2]
-        with Pool() as p:
-            col_values = [x for x in p.imap_unordered(get_id_candidates, col_values, chunksize=64) if x[1]]
-        jobs[i] = (job[0], job[1], col_values, ids)
+        # Search through all values for ID occurences. to speed this up,
+        # remove anything that for sure doesn't match, like shorter items or non alphanum chars.
+        for i, job in enumerate(jobs):
+            col_values = [x for x in p.imap_unordered(get_id_candidates, job[2], chunksize=64) if x[1]]
+            jobs[i] = (job[0], job[1], col_values, ids)
 
-    check_embedded_id_types(jobs[i])
-    with Pool() as p:
         results.extend(p.map(check_embedded_id_types, jobs, chunksize=1))
 
     # Remove empty results, sort them for convenience, and format them for pretty printing.
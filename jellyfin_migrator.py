@@ -20,17 +20,21 @@ import sqlite3
 import json
 import hashlib
 import binascii
+import io
 import xml.etree.ElementTree as ET
 import argparse
 import sys
 import uuid
 from pathlib import Path
 from shutil import copy
-from time import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from time import time, gmtime
 from jellyfin_id_scanner import *
 import datetime
+import calendar
 from string import ascii_letters
 import os
+import re
 
 
 # TODO BEFORE YOU START:
@@ -442,6 +446,127 @@ def print_log(*args, **kwargs):
         _log_write_count = 0
 
 
+# Applies replace_func (one of the replacers below) to all values of the dict or list "d" and
+# all nested dicts and lists, in place. The nested containers are walked with an explicit
+# stack of iterators instead of recursion: no function call per container and no recursion
+# limit for deeply nested json files. The values are still visited in the same order.
+# Returns d as well as how many items have been modified or ignored.
+def replace_in_containers(d, replace_func, to_replace: dict):
+    modified, ignored = 0, 0
+    stack = [(d, iter(d.items()) if type(d) is dict else enumerate(d))]
+    while stack:
+        container, items = stack[-1]
+        for k, v in items:
+            if type(v) is dict:
+                stack.append((v, iter(v.items())))
+                break
+            if type(v) is list:
+                stack.append((v, enumerate(v)))
+                break
+            container[k], mo, ig = replace_func(v, to_replace)
+            modified += mo
+            ignored  += ig
+        else:
+            # All items of this container have been processed.
+            stack.pop()
+    return d, modified, ignored
+
+
+# Compiled versions of the replacement dicts, see compile_root_replacements.
+_compiled_replacements = dict()
+
+
+# Converts a replacement dict for recursive_root_path_replacer to a dict with
+#  * "entries": a list of (source path parts, number of parts, destination) tuples. The order
+#    of the dict is kept (first match wins). "target_path_slash" and "log_no_warnings" are no
+#    paths and are left out. The parts are normalized by os.path.normcase, which makes the
+#    comparison case-insensitive on windows, just like Path.is_relative_to.
+#  * "single_parts": the (normalized) sources consisting of a single part, f.ex. "%AppDataPath%".
+#    None if there's a source without any parts, which matches everything.
+#  * "results": an initially empty dict for caching the results of replace_root_path.
+#  * "target_path_slash" and "log_no_warnings": the settings from the dict.
+# The result is cached per dict (the replacement dicts don't change while they're in use).
+def compile_root_replacements(to_replace: dict):
+    cached = _compiled_replacements.get(id(to_replace))
+    if cached is not None and cached[0] is to_replace:
+        return cached[1]
+    entries = []
+    for src, dst in to_replace.items():
+        if src in ("target_path_slash", "log_no_warnings"):
+            continue
+        src_parts = tuple(os.path.normcase(part) for part in Path(src).parts)
+        entries.append((src_parts, len(src_parts), dst))
+    single_parts = {src_parts[0] for src_parts, src_len, dst in entries if src_len == 1}
+    if any(src_len == 0 for src_parts, src_len, dst in entries):
+        single_parts = None
+    compiled = {
+        "entries": entries,
+        "single_parts": single_parts,
+        "results": dict(),
+        "target_path_slash": to_replace["target_path_slash"],
+        "log_no_warnings": to_replace.get("log_no_warnings", False),
+    }
+    # The dict itself is stored, too. This keeps it alive, so its id can't be reused.
+    _compiled_replacements[id(to_replace)] = (to_replace, compiled)
+    return compiled
+
+
+# Replaces the root of a single path (string or object) "d" according to the compiled
+# replacements (see compile_root_replacements). Used by recursive_root_path_replacer.
+# Returns the (un)modified path, how many items have been modified or ignored, and whether
+# the user should be warned about a path without replacement.
+def replace_root_path(d, compiled: dict):
+    modified, ignored, warn = 0, 0, False
+    # Most strings in the databases aren't paths at all. Without any (back)slash or drive colon,
+    # a string is a path with a single part (at most). That only matches single part sources
+    # and never has enough parents for a warning, hence the Path object can be skipped.
+    if type(d) is str and "/" not in d and "\\" not in d and ":" not in d:
+        single_parts = compiled["single_parts"]
+        if single_parts is not None and os.path.normcase(d) not in single_parts:
+            return d, modified, ignored + 1, warn
+    try:
+        p = Path(d)
+    except:
+        # This actually doesn't occur I think; Path() can pretty much convert any string into a Path
+        # object (which is equivalent to saying it doesn't have any restrictions for filenames).
+        ignored += 1
+    else:
+        found = False
+        # Same as p.is_relative_to(src) and dst / p.relative_to(src) for all entries, but only
+        # the parts of p are split and normalized (once), see compile_root_replacements.
+        parts = p.parts
+        normcase_parts = tuple(os.path.normcase(part) for part in parts)
+        for src_parts, src_len, dst in compiled["entries"]:
+            # A source without parts ("" or ".") only matches relative paths.
+            if normcase_parts[:src_len] == src_parts and (src_len or not p.anchor):
+                # This filters out all the "garbage" paths that actually were no paths to begin with
+                # and of course all the paths that are actually not relative to the src, dst couple
+                # currently checked.
+                p = Path(dst, *parts[src_len:])
+                # I guess 99% of the users won't migrate _to_ windows but the script could generate
+                # \ paths anyways.
+                # p.as_posix() makes sure that we always get a string with "/". Otherwise, on windows,
+                # str(p) would automatically return "\" paths.
+                d = p.as_posix().replace("/", compiled["target_path_slash"])
+                found = True
+                break
+        if found:
+            modified += 1
+        else:
+            ignored += 1
+            # No need to consider all the Path("sometext") objects. This might not be 100%
+            # accurate, but it eliminates 99.9999% of the false-positives. This output is
+            # after all only to give you a hint whether you missed a path.
+            # Also exclude URLs. Btw: pathlib can be quite handy for messing with URLs.
+            # The (cheap) user setting is checked first; with warnings disabled, the rest is skipped.
+            if not compiled["log_no_warnings"] \
+                    and len(p.parents) > 1 \
+                    and not d.startswith("https:") \
+                    and not d.startswith("http:"):
+                warn = True
+    return d, modified, ignored, warn
+
+
 # Recursively replace all paths in "d" which can be
 #  * a path object
 #  * a path string
@@ -452,54 +577,33 @@ def print_log(*args, **kwargs):
 # Returns the (un)modified object as well as how many items have been modified or ignored.
 def recursive_root_path_replacer(d, to_replace: dict):
     modified, ignored = 0, 0
-    if type(d) is dict:
-        for k, v in d.items():
-            d[k], mo, ig = recursive_root_path_replacer(v, to_replace)
-            modified += mo
-            ignored  += ig
-    elif type(d) is list:
-        for i, e in enumerate(d):
-            d[i], mo, ig = recursive_root_path_replacer(e, to_replace)
-            modified += mo
-            ignored  += ig
+    if type(d) is dict or type(d) is list:
+        return replace_in_containers(d, recursive_root_path_replacer, to_replace)
     elif type(d) is str or isinstance(d, pathlib.PurePath):
-        try:
-            p = Path(d)
-        except:
-            # This actually doesn't occur I think; Path() can pretty much convert any string into a Path
-            # object (which is equivalent to saying it doesn't have any restrictions for filenames).
-            ignored += 1
-        else:
-            found = False
-            for src, dst in to_replace.items():
-                if p.is_relative_to(src):
-                    # This filters out all the "garbage" paths that actually were no paths to begin with
-                    # and of course all the paths that are actually not relative to the src, dst couple
-                    # currently checked.
-                    p = dst / p.relative_to(src)
-                    # I guess 99% of the users won't migrate _to_ windows but the script could generate
-                    # \ paths anyways.
-                    # p.as_posix() makes sure that we always get a string with "/". Otherwise, on windows,
-                    # str(p) would automatically return "\" paths.
-                    d = p.as_posix().replace("/", to_replace["target_path_slash"])
-                    found = True
-                    break
-            if found:
-                modified += 1
-            else:
-                ignored += 1
-                # No need to consider all the Path("sometext") objects. This might not be 100%
-                # accurate, but it eliminates 99.9999% of the false-positives. This output is
-                # after all only to give you a hint whether you missed a path.
-                # Also exclude URLs. Btw: pathlib can be quite handy for messing with URLs.
-                if len(p.parents) > 1 \
-                        and not d.startswith("https:") \
-                        and not d.startswith("http:") \
-                        and not to_replace.get("log_no_warnings", False):
-                    print_log(f"No entry for this (presumed) path: {d}")
+        compiled = compile_root_replacements(to_replace)
+        results = compiled["results"]
+        # The same strings occur over and over again (f.ex. a folder in lots of rows), hence
+        # the result is cached per string. Path objects are rare and not cached.
+        result = results.get(d) if type(d) is str else None
+        if result is None:
+            result = replace_root_path(d, compiled)
+            if type(d) is str:
+                if len(results) >= 65536:
+                    # Keeps the memory usage bounded. Simply starting over is good enough here.
+                    results.clear()
+                results[d] = result
+        d, modified, ignored, warn = result
+        # The warning is repeated for every occurrence, cached or not.
+        if warn:
+            print_log(f"No entry for this (presumed) path: {d}")
     return d, modified, ignored
 
 
+# Matches strings consisting only of characters that occur in IDs (hex digits and -).
+# Same as set(s).issubset(set("0123456789abcdef-")), without creating two sets for each check.
+id_part_re = re.compile("[0-9a-f-]*")
+
+
 # Almost the same as recursive_root_path_replacer but for replacing id parts somewhere in
 # the paths including file names (can't use "is_relative_to" for checking).
 # ID paths usually have the format '.../83/833addde992893e93d0572907f8b4cad/...'. It's
@@ -508,16 +612,8 @@ def recursive_root_path_replacer(d, to_replace: dict):
 # starts at the beginning of the id string.
 def recursive_id_path_replacer(d, to_replace: dict):
     modified, ignored = 0, 0
-    if type(d) is dict:
-        for k, v in d.items():
-            d[k], mo, ig = recursive_id_path_replacer(v, to_replace)
-            modified += mo
-            ignored  += ig
-    elif type(d) is list:
-        for i, e in enumerate(d):
-            d[i], mo, ig = recursive_id_path_replacer(e, to_replace)
-            modified += mo
-            ignored  += ig
+    if type(d) is dict or type(d) is list:
+        return replace_in_containers(d, recursive_id_path_replacer, to_replace)
     elif type(d) is str or isinstance(d, pathlib.PurePath):
         try:
             p = Path(d)
@@ -530,41 +626,38 @@ def recursive_id_path_replacer(d, to_replace: dict):
 
             src, dst = "", ""
 
-            if set(p.stem).issubset(set("0123456789abcdef-")):
+            if id_part_re.fullmatch(p.stem):
                 dst = to_replace.get(p.stem, "")
                 if dst:
                     found = True
                     p = p.with_stem(dst)
 
             if not found:
-                for part in p.parts[:-1]:
+                parts = p.parts
+                for part in parts[:-1]:
                     # Check if it can actually be an ID. If so, look it up (which is expensive).
-                    if set(part).issubset(set("0123456789abcdef-")):
+                    if id_part_re.fullmatch(part):
                         src = part
                         dst = to_replace.get(part, "")
                         if dst:
                             break
                 if dst:
                     found = True
-                    q = Path()
-                    # Find folder as path object that needs to be changed
-                    q = p
-                    while p.name != src:
-                        p = p.parent
-                    # q becomes the part relative to the now determined p part (with p.stem = id)
-                    q = q.relative_to(p)
-                    p = p.with_name(dst)
-
-                    # Check if the parent folder starts with byte(s) from the id
-                    if src.startswith(p.parent.name):
-                        # If so, move the already replaced part from p to q
-                        q = p.name / q
-                        p = p.parent
-                        # Replace required number of bytes
-                        p = p.with_name(dst[:len(p.name)])
-
-                    # Merge q and p back together
-                    p = p / q
+                    # Work on the parts of the path instead of walking up with p.parent.
+                    # Find the folder that needs to be changed (the last one with that name).
+                    i = len(parts) - 2 - parts[-2::-1].index(src)
+                    new_parts = list(parts)
+                    new_parts[i] = dst
+
+                    # Check if the parent folder starts with byte(s) from the id. The anchor
+                    # (f.ex. "/") is no folder name.
+                    if i > 1 or (i == 1 and not p.anchor):
+                        parent = parts[i - 1]
+                        if src.startswith(parent):
+                            # Replace required number of bytes
+                            new_parts[i - 1] = dst[:len(parent)]
+
+                    p = Path(*new_parts)
             if found:
                 modified += 1
                 # I guess 99% of the users won't migrate _to_ windows but the script could generate
@@ -581,8 +674,30 @@ def recursive_id_path_replacer(d, to_replace: dict):
     return d, modified, ignored
 
 
+# Opens a sqlite database for the bulk updates done by this script. All changes of one
+# function are written in a single transaction (python's sqlite3 module opens it implicitly
+# with the first modification, the functions commit at the end). On top of that:
+#   * synchronous=NORMAL: fewer syncs per commit.
+#   * temp_store=MEMORY: temporary tables and indices (f.ex. from update_db_table_ids)
+#     don't go to disk.
+#   * A 256 MiB page cache instead of the default 2 MiB, so the full table scans don't
+#     re-read the same pages.
+#   * Reads through a 256 MiB memory map instead of read() calls into the page cache.
+# All of these only apply to this connection. The journal mode on the other hand would be stored
+# in the database file (even for preview runs), hence it's left alone. WAL wouldn't gain much
+# anyways with a single commit per function and is unreliable on network file systems.
+def open_db(file):
+    con = sqlite3.connect(file)
+    con.execute("PRAGMA synchronous=NORMAL")
+    con.execute("PRAGMA temp_store=MEMORY")
+    con.execute("PRAGMA cache_size=-262144")
+    con.execute("PRAGMA mmap_size=268435456")
+    return con
+
+
+# con: open connection to the database containing table, see process_file.
 def update_db_table(
-        file,
+        con,
         replace_dict,
         replace_func,
         table,
@@ -594,8 +709,6 @@ def update_db_table(
     # Initialize local variables
     rows_count, modified, ignored = 0, 0, 0
 
-    # Initialize sqlite3 objects
-    con = sqlite3.connect(file)
     cur = con.cursor()
 
     # If only one item has been specified, convert it to a list with one item instead.
@@ -615,43 +728,79 @@ def update_db_table(
     # It's important to note that the json columns come first, followed by the path columns
     columns = ", ".join([f"`{e}`" for e in list(json_columns) + list(path_columns)] + list(jf_image_columns))
 
-    # Query the unique IDs of all rows. Note: we cannot iterate over the rows using
+    # Note: we cannot iterate over the rows using
     #     for row in cur.execute(get rows)
-    # because the rows are modified by the loop, which breaks that iterator. Hence
-    # the solution with reading all row ids and iterating over them instead.
-    # Note: The cur.execute yields tuples with all the columns queried. Which means that
-    # the array below actually contains _tuples_ with the id. This is however desirable
-    # in our case; see below where id is used.
-    todo = [rowid for rowid in cur.execute(f"SELECT `rowid` FROM `{table}`") if rowid[0]]
-    rows_count = len(todo)
+    # because the rows are modified further below, which breaks that iterator. Instead of reading
+    # the whole table at once, the rows are read in pages ordered by rowid, see read_pages.
+    page_size = 5000
+    first_page_query = f"SELECT `rowid`, {columns} FROM `{table}` ORDER BY `rowid` LIMIT {page_size}"
+    next_page_query = f"SELECT `rowid`, {columns} FROM `{table}` WHERE `rowid` > ? ORDER BY `rowid` LIMIT {page_size}"
+    rows_count = cur.execute(f"SELECT COUNT(*) FROM `{table}`").fetchone()[0]
+
+    # Modified rows are not written back one by one. They're collected in updates, grouped by
+    # the columns that have changed, and written with one executemany per group (see
+    # flush_updates). updates has the structure {(column_name, ...): [(value, ..., rowid), ...]}.
+    updates = dict()
+    # The UPDATE query of each column combination is built once and reused for every flush.
+    # Identical query strings also let sqlite3 reuse its prepared statement.
+    # update_queries has the structure {(column_name, ...): query}.
+    update_queries = dict()
+
+    def flush_updates():
+        for keys, args in updates.items():
+            query = update_queries.get(keys)
+            if query is None:
+                # Similar to the initial query we construct a comma separated list of the columns,
+                # only this time we write
+                #     `columnname` = ?
+                # While the new values are all strings, the question mark avoids any issues with
+                # handling backslashes etc. The library offers an easy, built-in way to do it so
+                # there's no reason to mess with it myself.
+                query = f"UPDATE `{table}` SET {', '.join([f'`{k}` = ?' for k in keys])} WHERE `rowid` = ?"
+                update_queries[keys] = query
+            try:
+                cur.executemany(query, args)
+            except Exception as e:
+                # This was mainly for debugging purposes and shouldn't be reached anymore. Doesn't
+                # hurt to have it though.
+                print_log("Error:", e)
+                print_log("Query:", query)
+                print_log(e)
+                exit()
+            else:
+                if cur.rowcount < len(args):
+                    # This was mainly for debugging purposes and shouldn't be reached anymore.
+                    # Doesn't hurt to have it though.
+                    print_log("No data modified!")
+                    print_log("Query:", query)
+                    print_log(f"{cur.rowcount} of {len(args)} rows updated.")
+                    exit()
+        updates.clear()
+
+    # Yields the rows of the table one page after the other. Each page starts after the last rowid
+    # of the previous one, so only one page is held in memory. The modified rows of a page are
+    # written back before the next page is read.
+    def read_pages():
+        page = cur.execute(first_page_query).fetchall()
+        while page:
+            yield from page
+            flush_updates()
+            page = cur.execute(next_page_query, (page[-1][0],)).fetchall()
+
     t = time()
-    for progress, id in enumerate(todo):
+    for progress, (rowid, *row) in enumerate(read_pages()):
         # Print the progress every second. Note: this is the only usage of the "progress" variable.
         now = time()
         if now - t > 1:
             print_log(f"Progress: {progress} / {rows_count} rows")
             t = now
 
-        # Query the columns we want to check/modify of the current row (selected by id).
-        # Since the id is a binary object, it's not directly included in the f-string.
-        # The cur.execute expects as second argument a _tuple_ with as many elements as
-        # there are ? characters in the query string. This is the reason why we kept the
-        # IDs as tuple. The only other place where this id is used is in the update query
-        # at the end of the loop which requires - just like here - a tuple.
-        row = [r for r in cur.execute(f"SELECT {columns} FROM `{table}` WHERE `rowid` = ?", id)]
-        # This _should_ not occur, but I think I have seen it happen rarely. Safe is safe.
-        if len(row) != 1:
-            print_log(f"Error with rowid {id}! Resulted in {len(row)} rows instead of 1. Skipping.")
+        # This _should_ not occur, but safe is safe.
+        if not rowid:
             continue
-        # cur.execute returns a 2D tuple, containing all rows matching the query, and then
-        # in each row the selected columns. We only selected a single row, hence row[0] is
-        # all we care about (and all there is, see error handling above).
-        # Secondly we want row to be modifiable, hence the conversion to a list.
-        # list(row[0]) would btw return a list with 1 element: the tuple of the columns.
-        row = [e for e in row[0]]
 
         # result has the structure {column_name: updated_data} which makes it very easy to build
-        # the update query at the end.
+        # the update query. Only columns where at least one path has been modified are included.
         result = dict()
 
         # It's important to note that the tuple from cur.execute contains the columns _in the order
@@ -667,14 +816,16 @@ def update_db_table(
                 data, mo, ig = replace_func(data, replace_dict)
                 modified += mo
                 ignored  += ig
-                result[json_columns[i]] = json.dumps(data)
+                if mo:
+                    result[json_columns[i]] = json.dumps(data)
         for i, path in enumerate(paths):
             # One could also skip the empty objects here, but recursive_path_replacer handles them
             # just fine (leaves them untouched).
             path, mo, ig = replace_func(path, replace_dict)
             modified += mo
             ignored  += ig
-            result[path_columns[i]] = path
+            if mo:
+                result[path_columns[i]] = path
         for i, imgs in enumerate(jf_imgs):
             # Jellyfin Image Metadata. Some DB entries look like this:
             #     %MetadataPath%\library\71\71d037e6e74015a5a6231ce1b7912acf\poster.jpg*637693022742223153*Primary*198*198*eJC5#hK#Dj9GR/V@j]xuX8NG0x+xgN%MxaX7spNGnitQ$kK0wyV@Rj # noqa
@@ -688,6 +839,7 @@ def update_db_table(
             if not imgs:
                 continue
             imgs = imgs.split("|")
+            imgs_modified = 0
             for j, img_properties in enumerate(imgs):
                 if not img_properties:
                     continue
@@ -697,45 +849,18 @@ def update_db_table(
                 imgs[j] = "*".join(img_properties)
                 modified += mo
                 ignored  += ig
-            imgs = "|".join(imgs)
-            result[jf_image_columns[i]] = imgs
-
-        # Similar to the initial query we construct a comma separated list of the columns, only this
-        # time we write
-        #     `columnname` = ?
-        # While the new values are all strings, the question mark avoids any issues with handling
-        # backslashes etc. The library offers an easy, built-in way to do it so there's no reason
-        # to mess with it myself.
-        # Note that this relies on result.keys() and result.values() returning the entries in the
-        # same order (which is guaranteed).
-        # Note: it can happen that no changes are made at all. In this case we can abort here and
-        #       go for the next job from the todo_list.
+                imgs_modified += mo
+            if imgs_modified:
+                result[jf_image_columns[i]] = "|".join(imgs)
+
+        # Note: it can happen that no changes are made at all. In this case there's nothing to
+        # write back for this row.
         if not result:
             continue
-        keys = ", ".join([f"`{k}` = ?" for k in result.keys()])
-        query = f"UPDATE `{table}` SET {keys} WHERE `rowid` = ?"
-
-        # The query has a question mark for each updated column plus one for the id to identify
-        # the correct row.
-        args = tuple(result.values()) + id
-        try:
-            cur.execute(query, args)
-        except Exception as e:
-            # This was mainly for debugging purposes and shouldn't be reached anymore. Doesn't
-            # hurt to have it though.
-            print_log("Error:", e)
-            print_log("Query:", query)
-            print_log("Args: ", args)
-            print_log(e)
-            exit()
-        else:
-            if cur.rowcount < 1:
-                # This was mainly for debugging purposes and shouldn't be reached anymore.
-                # Doesn't hurt to have it though.
-                print_log("No data modified!")
-                print_log("Query:", query)
-                print_log("Args: ", args)
-                exit()
+        # The update query has a question mark for each updated column plus one for the id to
+        # identify the correct row. Note that this relies on result.keys() and result.values()
+        # returning the entries in the same order (which is guaranteed).
+        updates.setdefault(tuple(result.keys()), []).append(tuple(result.values()) + (rowid,))
     print_log(f"Processed {rows_count} rows in table {table}. ")
     print_log(f"{modified} paths have been modified.")
 
@@ -744,7 +869,9 @@ def update_db_table(
     if not preview:
         # Write the updated database back to the file.
         con.commit()
-    con.close()
+    else:
+        # The connection is shared with the other tables, don't let them commit this one.
+        con.rollback()
 
 
 # Walks through an XML file and checks *all* entries.
@@ -765,7 +892,77 @@ def update_xml(file: Path, replace_dict: dict, replace_func) -> None:
         modified += mo
         ignored  += ig
     print_log(f"Processed {ignored + modified} elements. {modified} paths have been modified.")
-    tree.write(file)  # , encoding="utf-8")
+    # The file is already a copy of the source. Nothing modified = nothing to write.
+    if not modified:
+        return
+    # ElementTree writes every single tag and attribute separately to the file. Serialize to
+    # memory first (same default encoding as before) and write the result at once.
+    buf = io.BytesIO()
+    tree.write(buf)  # , encoding="utf-8")
+    with open(file, "wb") as f:
+        f.write(buf.getbuffer())
+
+
+def update_mblink(file: Path, replace_dict: dict, replace_func) -> None:
+    # .mblink files only contain a path, nothing else.
+    with open(file, "r", encoding="utf-8") as f:
+        path = f.read()
+    path, modified, ignored = replace_func(path, replace_dict)
+    print_log(f"Processed {modified + ignored} paths, {modified} paths have been modified.")
+    # The file is already a copy of the source. Nothing modified = nothing to write.
+    if not modified:
+        return
+    with open(file, "w", encoding="utf-8") as f:
+        f.write(path)
+
+
+def update_json(file: Path, replace_dict: dict, replace_func) -> None:
+    # There are also json files with the ending .js but I haven't found any with paths.
+    # Load the file by the json module (resulting in a dict or list object) and process
+    # them by recursive_path_replacer which handles these structures.
+    with open(file, "r", encoding="utf-8") as f:
+        j = json.load(f)
+    j, modified, ignored = replace_func(j, replace_dict)
+    print_log(f"Processed {modified + ignored} paths, {modified} paths have been modified.")
+    # The file is already a copy of the source. Nothing modified = nothing to write.
+    if not modified:
+        return
+    # indent 2 seems to be the default formatting for jellyfin json files.
+    # json.dump would call f.write for every single token, hence the whole text is
+    # generated first and then written at once.
+    j = json.dumps(j, indent=2)
+    with open(file, "w", encoding="utf-8") as f:
+        f.write(j)
+
+
+# Which function updates which file type (by suffix). process_file looks the suffix up
+# once instead of testing it against every known type. .db files aren't listed since
+# they need the table configuration from the job; process_file handles them itself.
+file_updaters = {
+    ".xml": update_xml,
+    ".nfo": update_xml,
+    ".mblink": update_mblink,
+    ".json": update_json,
+}
+
+
+# Path separators of the OS this script runs on, f.ex. "\\/" on windows.
+path_seps = os.sep + (os.altsep or "")
+
+
+# Places a path (string) that isn't absolute below target_root and returns it as string.
+# Same rule as Path.is_absolute: on windows, an absolute path needs a drive letter, too.
+# Leading separators are stripped, otherwise the path would end up relative to the _root_
+# of target_root instead of relative to target_root. Plain string operations, no Path objects.
+# Windows paths with a drive but no root (f.ex. "C:foo") are returned unchanged. They're
+# relative to the current folder of that drive, not to target_root.
+def below_target_root(path: str) -> str:
+    drive, rest = os.path.splitdrive(path)
+    if drive:
+        return path
+    if not rest or rest[0] not in path_seps or os.name == "nt":
+        return os.path.join(target_root, rest.lstrip(path_seps))
+    return path
 
 
 # Remember if the user wants to ignore all future warnings.
@@ -777,6 +974,7 @@ def get_target(
         target: Path,
         replacements: dict,
         no_log: bool = False,
+        copy_func=copy,
 ) -> Path:
     # Not the cleanest solution for remembering it between function calls but good enough here.
     global user_wants_inplace_warning
@@ -797,13 +995,7 @@ def get_target(
         original_source = original_root / source.relative_to(source_root)
         target, idgaf1, idgaf2 = recursive_root_path_replacer(original_source, to_replace=replacements)
         target, idgaf1, idgaf2 = recursive_root_path_replacer(target, to_replace=fs_path_replacements)
-        target = Path(target)
-        if not target.is_absolute():
-            if target.is_relative_to("/"):
-                # Otherwise the line below will make target relative to the _root_ of target_root
-                # instead of relative to target_root.
-                target = target.relative_to("/")
-            target = target_root / target
+        target = Path(below_target_root(str(target)))
 
     # If source and target are the same there are two possibilities:
     #     1. The user actually wants to work on the given source files; maybe he already created
@@ -837,7 +1029,7 @@ def get_target(
         else:
             if not no_log:
                 print_log("Copying...", target, end=" ")
-            copy(source, target)
+            copy_func(source, target)
             if not no_log:
                 print_log("Done.")
     return target
@@ -876,33 +1068,21 @@ def process_file(
             library_db_source_path = source
             library_db_target_path = target
         # sqlite file. In this case table specifies which tables within that file have columns to check.
-        # Iterate over those.
-        for table, kwargs in tables.items():
-            print_log("Processing table", table)
-            # The remaining function arguments (**kwards) contain the details about the columns to process.
-            # See update_db_table and/or the todo_list.
-            update_db_table(file=target, replace_dict=replacements, replace_func=replace_func, table=table, **kwargs)
-    elif target.suffix == ".xml" or target.suffix == ".nfo":
-        update_xml(file=target, replace_dict=replacements, replace_func=replace_func)
-    elif target.suffix == ".mblink":
-        # .mblink files only contain a path, nothing else.
-        with open(target, "r", encoding="utf-8") as f:
-            path = f.read()
-        path, modified, ignored = replace_func(path, replacements)
-        print_log(f"Processed {modified + ignored} paths, {modified} paths have been modified.")
-        with open(target, "w", encoding="utf-8") as f:
-            f.write(path)
-    elif target.suffix == ".json":
-        # There are also json files with the ending .js but I haven't found any with paths.
-        # Load the file by the json module (resulting in a dict or list object) and process
-        # them by recursive_path_replacer which handles these structures.
-        with open(target, "r", encoding="utf-8") as f:
-            j = json.load(f)
-        j, modified, ignored = replace_func(j, replacements)
-        print_log(f"Processed {modified + ignored} paths, {modified} paths have been modified.")
-        with open(target, "w", encoding="utf-8") as f:
-            # indent 2 seems to be the default formatting for jellyfin json files.
-            json.dump(j, f, indent=2)
+        # Iterate over those. The database is opened once for all of them.
+        if tables:
+            con = open_db(target)
+            for table, kwargs in tables.items():
+                print_log("Processing table", table)
+                # The remaining function arguments (**kwards) contain the details about the columns to process.
+                # See update_db_table and/or the todo_list.
+                update_db_table(con=con, replace_dict=replacements, replace_func=replace_func, table=table, **kwargs)
+            con.close()
+    else:
+        # Any other file type is looked up in file_updaters. Files without a matching entry
+        # are only copied.
+        updater = file_updaters.get(target.suffix)
+        if updater is not None:
+            updater(file=target, replace_dict=replacements, replace_func=replace_func)
 
     # If we're updating path ids we also need to check the paths of the files themselves
     # and move them if they're relative to a path.
@@ -917,12 +1097,12 @@ def process_file(
             source.replace(target)
 
 
-# Processes the todo_list.
-# It handles potential wildcards in the file paths and keeps track
-# which files have already been processed. This allows you to have an
-# automatic, wildcard copy in your todo_list that just copies the files
-# to the (modified) destinations without processing them and without
-# modifying those that have already been copied _and_ modified.
+# Defaults for the optional entries of a todo_list job.
+job_defaults = {
+    "no_log": False,
+}
+
+
 # Processes the todo_list.
 # It handles potential wildcards in the file paths and keeps track
 # which files have already been processed. This allows you to have an
@@ -936,85 +1116,144 @@ def process_file(
 # process_func: function to apply to jobs of lst.
 # replace_func: function used by process_func to do the replacing of paths, ...
 def process_files(lst: list, process_func, replace_func, path_replacements):
+    max_workers = min(32, (os.cpu_count() or 1) * 4)
+    with ThreadPoolExecutor(max_workers=max_workers) as copy_pool:
+        try:
+            process_files_with_pool(lst, process_func, replace_func, path_replacements,
+                                    copy_pool, max_pending=4 * max_workers)
+        except BaseException:
+            # Error or CTRL + C: drop the queued copies. Otherwise leaving the with block would
+            # wait until all of them are done. Copies that are already running still finish.
+            copy_pool.shutdown(wait=False, cancel_futures=True)
+            raise
+
+
+# Returns the size of a file in bytes, 0 if it can't be determined.
+def file_size(path: Path) -> int:
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return 0
+
+
+# Copy job for the bulk copy thread pool. Returns the size for the progress output.
+def copy_get_size(source: Path, target: Path) -> int:
+    copy(source, target)
+    return file_size(source)
+
+
+# Does the actual work for process_files. copy_pool is the thread pool for bulk copy jobs,
+# max_pending the number of copies that may be queued or running at the same time.
+def process_files_with_pool(lst: list, process_func, replace_func, path_replacements, copy_pool, max_pending: int):
     done = set()
     for job in lst:
-        if "no_log" not in job:
-            job["no_log"] = False
+        # Everything except source and target is passed on to process_func unchanged.
+        # Merge the defaults and strip source/target once per job instead of once per
+        # file matched by the job.
+        job_kwargs = {k: v for k, v in (job_defaults | job).items() if k not in ("source", "target")}
+        no_log = job_kwargs["no_log"]
         source = job["source"]
         print_log(f"Current job from todo_list: {source}")
+
+        # For bulk operations with no_log, show periodic progress
+        file_count = 0
+        bytes_copied = 0
+        last_progress_time = time()
+
+        def count_file(size: int):
+            nonlocal file_count, bytes_copied, last_progress_time
+            file_count += 1
+            bytes_copied += size
+            # Show progress every 2 seconds for bulk operations
+            now = time()
+            if now - last_progress_time >= 2:
+                print_log(f"  Progress: {file_count} files, {bytes_copied / (1024*1024):.1f} MB copied...")
+                last_progress_time = now
+
+        # Bulk copy jobs (copy only, no log) mostly copy lots of small files, which is limited
+        # by file system latency rather than bandwidth. Their copies are handed to a thread pool
+        # so that many of them are in flight at the same time. Everything else (target paths,
+        # folders, the done set, ...) is still handled here, in order.
+        # pending: future -> target of the copies in flight. These files are counted for the
+        # progress output once their copy is finished.
+        pending = dict()
+        pending_targets = set()
+        submitted = False
+
+        def finish_copies(futures):
+            for f in futures:
+                pending_targets.discard(pending.pop(f))
+                # result() raises any error from the copy just like a direct call to copy would have.
+                count_file(f.result())
+
+        def submit_copy(src, dst):
+            nonlocal submitted
+            # Another source with the same target is still being copied (and target.exists()
+            # may not see it yet). The first source wins, just like with direct copies.
+            if dst in pending_targets:
+                return
+            submitted = True
+            # Don't queue up the whole job; wait until some of the copies are done.
+            while len(pending) >= max_pending:
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                finish_copies(finished)
+            pending[copy_pool.submit(copy_get_size, src, dst)] = dst
+            pending_targets.add(dst)
+
+        pooled = job_kwargs.get("copy_only") and no_log
+        copy_func = submit_copy if pooled else copy
         if "*" in str(source):
             # Path has wildcards, process all matching files.
             #
             # Ironically Path.glob can't handle Path objects, hence the need
             # to convert them to a string...
             # It is expected that all these paths are relative to source_root.
-            source = source.relative_to(source_root)
-
-            # For bulk operations with no_log, show periodic progress
-            file_count = 0
-            bytes_copied = 0
-            last_progress_time = time()
-
-            for src in source_root.glob(str(source)):
-                if src.is_dir():
-                    continue
-                if src in done:
-                    # File has already been processed by this script.
-                    continue
-                done.add(src)
-
-                # Track file size for progress reporting
-                if job["no_log"]:
-                    try:
-                        bytes_copied += src.stat().st_size
-                    except OSError:
-                        pass
-                    file_count += 1
-
-                    # Show progress every 2 seconds for bulk operations
-                    now = time()
-                    if now - last_progress_time >= 2:
-                        print_log(f"  Progress: {file_count} files, {bytes_copied / (1024*1024):.1f} MB copied...")
-                        last_progress_time = now
-
-                target = get_target(
-                    source=src,
-                    target=job["target"],
-                    replacements=path_replacements,
-                    no_log=job["no_log"],
-                )
-
-                # pass the job as is but with non-wildcard source path.
-                process_func(
-                    replace_func=replace_func,
-                    source=src,
-                    target=target,
-                    **{k: v for k, v in job.items() if k not in ("source", "target")},
-                )
-
-            # Final summary for bulk operations
-            if job["no_log"] and file_count > 0:
-                print_log(f"  Completed: {file_count} files, {bytes_copied / (1024*1024):.1f} MB total")
+            sources = source_root.glob(str(source.relative_to(source_root)))
         else:
-            # No wildcards, process the path directly - if it hasn't already
-            # been processed.
-            if source in done:
+            # No wildcards, process the path directly. It goes through the same
+            # loop as the wildcard matches.
+            sources = (source,)
+
+        for src in sources:
+            if src.is_dir():
+                # Wildcards match folders all the time, but a job that names a folder
+                # directly is most likely a mistake in the todo_list.
+                if src is source:
+                    print_log(f"Skipping directory {src}. Use wildcards to process its content.")
+                continue
+            if src in done:
+                # File has already been processed by this script.
                 continue
-            done.add(source)
+            done.add(src)
 
+            submitted = False
             target = get_target(
-                source=source,
+                source=src,
                 target=job["target"],
                 replacements=path_replacements,
-                no_log=job["no_log"],
+                no_log=no_log,
+                copy_func=copy_func,
             )
 
+            # Track file size for progress reporting. Copies handed to the pool are counted
+            # when they're finished (see finish_copies).
+            if no_log and not submitted:
+                count_file(file_size(src))
+
+            # pass the job as is but with non-wildcard source path.
             process_func(
                 replace_func=replace_func,
-                source=source,
+                source=src,
                 target=target,
-                **{k: v for k, v in job.items() if k not in ("source", "target")},
+                **job_kwargs,
             )
+
+        # Wait for the remaining copies of this job.
+        finish_copies(wait(pending).done)
+
+        # Final summary for bulk operations
+        if no_log and file_count > 0:
+            print_log(f"  Completed: {file_count} files, {bytes_copied / (1024*1024):.1f} MB total")
         print_log("")
 
 
@@ -1024,6 +1263,32 @@ def get_dotnet_MD5(s: str):
     return hashlib.md5(s.encode("utf-16-le")).digest()
 
 
+# Fallback for update_db_table_ids if the batched update of a column runs into duplicates.
+# Applies the (new_id, old_id) pairs one at a time and deletes the rows whose old ID can't be
+# changed because its new ID already exists. The rows are deleted right away and not collected
+# for later: a later pair may map another ID onto exactly the old ID that's being freed here.
+def update_db_column_ids(cur, table, column, query, pairs):
+    t = time()
+    for progress, (new_id, old_id) in enumerate(pairs):
+        # Print the progress every second. Note: this is the only usage of the "progress" variable.
+        now = time()
+        if now - t > 1:
+            print_log(f"Progress: {progress} / {len(pairs)} IDs")
+            t = now
+        try:
+            cur.execute(query, (new_id, old_id))
+        except sqlite3.IntegrityError:
+            rows = [x for x in cur.execute(f"SELECT * FROM `{table}` WHERE `{column}` = ?", (old_id,))]
+            # The column names come with the result (cursor.description); no need to ask
+            # PRAGMA_TABLE_INFO for them separately.
+            col_names  = [x[0] for x in cur.description]
+            rows = [dict(zip(col_names, row)) for row in rows]
+            print_log(f"Encountered {len(rows)} duplicated entries")
+            for i, row in enumerate(rows):
+                print_log(f"Deleting ({i+1}/{len(rows)}): ", row)
+            cur.execute(f"DELETE FROM `{table}` WHERE `{column}` = ?", (old_id,))
+
+
 # Derived/copied from update_db_table. I couldn't see a good way to do this without
 # copying. The data structures and processing are too different for path and id jobs.
 # Note: kwargs is due to how process_files works. It passes a lot of stuff from the
@@ -1040,41 +1305,63 @@ def update_db_table_ids(
     print_log("Updating Item IDs in database... ")
 
     # Initialize sqlite3 objects
-    con = sqlite3.connect(target)
+    con = open_db(target)
     cur = con.cursor()
 
+    # The replacements of each ID type are copied into a temporary table (once per ID type and
+    # database) so that sqlite can match them against a column by itself instead of sending
+    # every distinct value of the column through python.
+    # id_maps has the structure {id_type: temp_table_name}.
+    id_maps = dict()
+
     updated_ids_count = 0
-    # That's a very nested loop and could probably be written more efficiently using
-    # multiprocessing and more advanced sqlite queries.
     for table, columns_by_id_type in tables.items():
         for id_type, columns in columns_by_id_type.items():
+            if not columns:
+                continue
+            replacements = ids[id_type]
+            if id_type not in id_maps:
+                id_map = f"id_map_{len(id_maps)}"
+                cur.execute(f"CREATE TEMP TABLE `{id_map}` (`old` PRIMARY KEY, `new`)")
+                cur.executemany(f"INSERT INTO `{id_map}` VALUES (?, ?)", replacements.items())
+                id_maps[id_type] = id_map
+            id_map = id_maps[id_type]
             for column in columns:
                 print_log(f"Updating {column} IDs in table {table}...")
-                # See comment about iterating over rows while modifying them in update_db_table.
-                rows = [r for r in cur.execute(f"SELECT DISTINCT `{column}` from `{table}`")]
-                progress = 0
-                rowcount = len(rows)
-                t = time()
-                for old_id, in rows:
-                    progress += 1
-                    # Print the progress every second. Note: this is the only usage of the "progress" variable.
-                    now = time()
-                    if now - t > 1:
-                        print_log(f"Progress: {progress} / {rowcount} rows")
-                        t = now
-                    if old_id in ids[id_type]:
-                        new_id = ids[id_type][old_id]
-                        try:
-                            cur.execute(f"UPDATE `{table}` SET `{column}` = ? WHERE `{column}` = ?", (new_id, old_id))
-                        except sqlite3.IntegrityError:
-                            col_names  = [x[0] for x in cur.execute(f"SELECT name FROM PRAGMA_TABLE_INFO('{table}')")]
-                            rows = [x for x in cur.execute(f"SELECT * FROM `{table}` WHERE `{column}` = ?", (old_id,))]
-                            rows = [dict(zip(col_names, row)) for row in rows]
-                            print_log(f"Encountered {len(rows)} duplicated entries")
-                            for i, row in enumerate(rows):
-                                print_log(f"Deleting ({i+1}/{len(rows)}): ", row)
-                            cur.execute(f"DELETE FROM `{table}` WHERE `{column}` = ?", (old_id,))
-                        updated_ids_count += 1
+                matching = f"`{column}` IN (SELECT `old` FROM `{id_map}`)"
+                found = cur.execute(f"SELECT COUNT(DISTINCT `{column}`) FROM `{table}` WHERE {matching}").fetchone()[0]
+                if not found:
+                    continue
+                # The savepoint lives inside the regular transaction so that commit (or preview)
+                # below still decides whether anything is written.
+                if not con.in_transaction:
+                    cur.execute("BEGIN")
+                cur.execute("SAVEPOINT ids")
+                try:
+                    # All IDs of the column are replaced by a single statement. Each row gets the
+                    # new ID of the value it had before the statement, so an ID that is both a
+                    # new and an old ID can't be replaced twice.
+                    cur.execute(
+                        f"UPDATE `{table}` SET `{column}` = "
+                        f"(SELECT `new` FROM `{id_map}` WHERE `old` = `{table}`.`{column}`) "
+                        f"WHERE {matching}"
+                    )
+                except sqlite3.IntegrityError:
+                    # At least one of the new IDs already exists in a unique column. Undo the
+                    # statement and redo the IDs one by one so the duplicates can be removed.
+                    cur.execute("ROLLBACK TO ids")
+                    # The pairs are collected before the rows are modified, see comment about iterating
+                    # over rows in update_db_table. Only the IDs that are actually replaced are read;
+                    # the rest of the column's distinct values never leave sqlite.
+                    pairs = [
+                        (replacements[old_id], old_id)
+                        for old_id, in cur.execute(f"SELECT DISTINCT `{column}` from `{table}` WHERE {matching}")
+                        if old_id in replacements
+                    ]
+                    query = f"UPDATE `{table}` SET `{column}` = ? WHERE `{column}` = ?"
+                    update_db_column_ids(cur, table, column, query, pairs)
+                cur.execute("RELEASE ids")
+                updated_ids_count += found
 
     # Once again, this came from the development and is not required anymore, especially
     # since by default the script is working on copies of the original files.
@@ -1089,7 +1376,7 @@ def get_ids():
     global library_db_target_path, ids
 
     print_log(f"Loading IDs from: {library_db_target_path}")
-    con = sqlite3.connect(library_db_target_path)
+    con = open_db(library_db_target_path)
     cur = con.cursor()
 
     # Jellyfin 10.10+ uses short class names. Map them to full names for ID calculation.
@@ -1111,37 +1398,56 @@ def get_ids():
 
     id_replacements_bin = dict()
 
+    # Items without a path or with a path relative to one of jellyfins %...% folders are
+    # skipped. This is filtered by sqlite instead of loading and discarding them here.
+    where = " WHERE `Path` IS NOT NULL AND `Path` != '' AND substr(`Path`, 1, 1) != '%'"
+
+    # Jellyfin 10.11+ stores the IDs as strings (e.g. "4b3a..." or with dashes), older
+    # versions as raw bytes. The whole column uses the same format, so it's checked once
+    # here instead of for every row.
+    id_is_text = cur.execute("SELECT typeof(`Id`) FROM `BaseItems` LIMIT 1").fetchone() == ("text",)
+
     # Try to find the correct columns (Discriminator vs type)
     try:
         query = "SELECT `Id`, `Discriminator`, `Path` FROM `BaseItems`"
-        cursor_iterator = cur.execute(query)
+        cursor_iterator = cur.execute(query + where)
     except sqlite3.OperationalError:
         print_log("Warning: 'Discriminator' column not found, trying 'type'...")
         query = "SELECT `Id`, `type`, `Path` FROM `BaseItems`"
-        cursor_iterator = cur.execute(query)
+        cursor_iterator = cur.execute(query + where)
 
-    count = 0
-    for guid, item_type, path in cursor_iterator:
-        if not path or path.startswith("%"):
-            continue
-
-        # --- FIX: FORCE BYTES CONVERSION ---
-        # If the DB returns a String (e.g. "4b3a..."), convert it to Raw Bytes
-        if isinstance(guid, str):
+    # --- FIX: FORCE BYTES CONVERSION ---
+    # If the DB returns Strings, convert them to Raw Bytes.
+    def text_ids_to_bytes(rows):
+        for guid, item_type, path in rows:
             try:
                 # This handles both hex strings and UUIDs with dashes
-                guid = uuid.UUID(guid).bytes
+                yield uuid.UUID(guid).bytes, item_type, path
             except ValueError:
                 # If it's garbage data, skip it
                 continue
-        # -----------------------------------
 
-        # Fix Type Mapping
-        if item_type in type_map:
-            item_type = type_map[item_type]
+    if id_is_text:
+        cursor_iterator = text_ids_to_bytes(cursor_iterator)
+    # -----------------------------------
+
+    # The ID is the MD5 of item type + path (see get_dotnet_MD5). There are only a few
+    # distinct item types, hence the MD5 state after the item type is computed once per
+    # type and each row continues from a copy of it with its path.
+    type_hashers = dict()
+
+    count = 0
+    for guid, item_type, path in cursor_iterator:
+        hasher = type_hashers.get(item_type)
+        if hasher is None:
+            # Fix Type Mapping
+            hasher = hashlib.md5(type_map.get(item_type, item_type).encode("utf-16-le"))
+            type_hashers[item_type] = hasher
 
         # Calculate what the NEW ID should be based on the NEW path
-        new_guid = get_dotnet_MD5(item_type + path)
+        hasher = hasher.copy()
+        hasher.update(path.encode("utf-16-le"))
+        new_guid = hasher.digest()
 
         # If the calculated ID is different from the existing ID, add to replacements
         if new_guid != guid:
@@ -1152,11 +1458,20 @@ def get_ids():
 
     ### Adapted from jellyfin_id_scanner
     # Now that 'k' (guid) and 'v' (new_guid) are guaranteed to be bytes, bid2sid will work.
-    id_replacements_str               = {bid2sid(k): bid2sid(v) for k, v in id_replacements_bin.items()}
-    id_replacements_str_dash          = {sid2did(k): sid2did(v) for k, v in id_replacements_str.items()}
-    id_replacements_ancestor_str      = {convert_ancestor_id(k): convert_ancestor_id(v) for k, v in id_replacements_str.items()}
-    id_replacements_ancestor_bin      = {sid2bid(k): sid2bid(v) for k, v in id_replacements_ancestor_str.items()}
-    id_replacements_ancestor_str_dash = {sid2did(k):sid2did(v) for k, v in id_replacements_ancestor_str.items()}
+    # All variants are computed in one pass over the replacements.
+    id_replacements_str               = dict()
+    id_replacements_str_dash          = dict()
+    id_replacements_ancestor_str      = dict()
+    id_replacements_ancestor_bin      = dict()
+    id_replacements_ancestor_str_dash = dict()
+    for k, v in id_replacements_bin.items():
+        k_str, v_str = bid2sid(k), bid2sid(v)
+        k_ancestor_str, v_ancestor_str = convert_ancestor_id(k_str), convert_ancestor_id(v_str)
+        id_replacements_str[k_str] = v_str
+        id_replacements_str_dash[sid2did(k_str)] = sid2did(v_str)
+        id_replacements_ancestor_str[k_ancestor_str] = v_ancestor_str
+        id_replacements_ancestor_bin[convert_ancestor_bin(k)] = convert_ancestor_bin(v)
+        id_replacements_ancestor_str_dash[sid2did(k_ancestor_str)] = sid2did(v_ancestor_str)
 
     ids = {
         "bin": id_replacements_bin,
@@ -1175,7 +1490,24 @@ def update_ids():
     return
 
 
+# Jellyfin's usual date format, f.ex. "2021-10-03 12:34:56.1234567Z", see jf_date_str_to_python_ns.
+jf_date_re = re.compile("([0-9]{4})-([0-9]{2})-([0-9]{2})[ T]([0-9]{2}):([0-9]{2}):([0-9]{2})(?:[.]([0-9]{1,9}))?Z?")
+
+
 def jf_date_str_to_python_ns(s: str):
+    # Fast path for the usual format. calendar.timegm converts the UTC date and time to seconds
+    # with plain integer math, no datetime object and no time zone handling required.
+    # timegm would silently roll out of range values (f.ex. month 13 or hour 25) over into another
+    # date. These are left to fromisoformat below which rejects them, as it always did.
+    m = jf_date_re.fullmatch(s)
+    if m:
+        *date_time, subseconds = m.groups()
+        year, month, day, hour, minute, second = [int(x) for x in date_time]
+        if year and 1 <= month <= 12 and 1 <= day <= calendar.monthrange(year, month)[1] \
+                and hour < 24 and minute < 60 and second < 60:
+            t = calendar.timegm((year, month, day, hour, minute, second))
+            return t * 1000000000 + int((subseconds or "0").ljust(9, "0"))
+
     # Python datetime has only support for microseconds because of resolution
     # problems. To convert from a date+time to ticks, the fractional seconds
     # part doesn't matter anyway (it remains the same). Hence, it's cut off
@@ -1207,23 +1539,25 @@ def get_datestr_from_python_time_ns(time_ns: int):
     # Doesn't matter anyway, we can add the whole sub-second part afterwards.
     time_s = time_ns // 1000000000
     time_frac_s_100ns = (time_ns // 100) % 10000000
-    timestamp = datetime.datetime.utcfromtimestamp(time_s).isoformat(sep=" ", timespec="seconds")
+    # gmtime instead of datetime.utcfromtimestamp, which is deprecated since Python 3.12.
+    t = gmtime(time_s)
     # Add back the sub-seconds part and the UTC time zone
-    timestamp += "." + str(time_frac_s_100ns).rjust(7, "0").rstrip("0") + "Z"
-    return timestamp
+    return (f"{t.tm_year:04d}-{t.tm_mon:02d}-{t.tm_mday:02d} {t.tm_hour:02d}:{t.tm_min:02d}:{t.tm_sec:02d}"
+            f".{time_frac_s_100ns:07d}".rstrip("0") + "Z")
 
 
 def delete_empty_folders(dir:str):
-    dir = Path(dir)
-
-    done = False
-    while not done:
-        done = True
-        for p in dir.glob("**"):
-            if not list(p.iterdir()):
-                print_log("Removing empty folder", p)
-                p.rmdir()
-                done = False
+    # os.walk with topdown=False lists every folder after all of its subfolders, so a folder
+    # whose subfolders have just been removed is already empty when it's reached. One pass
+    # is enough. rmdir fails on folders that aren't empty, which is the cheapest check anyway.
+    for path, dirnames, filenames in os.walk(dir, topdown=False):
+        if filenames:
+            continue
+        try:
+            os.rmdir(path)
+        except OSError:
+            continue
+        print_log("Removing empty folder", Path(path))
 
 
 def update_file_dates():
@@ -1232,19 +1566,27 @@ def update_file_dates():
     print_log("Updating file dates... Note: Reading file dates seems to be quite slow. "
               "This will take a couple minutes")
 
-    con = sqlite3.connect(library_db_target_path)
+    con = open_db(library_db_target_path)
     cur = con.cursor()
 
     # FIX: Changed TypedBaseItems -> BaseItems
+    # The rows are streamed from the cursor instead of being loaded all at once. That's
+    # safe because the updates are only written after the loop.
+    # Only items with a path and at least one date before 1970 (negative timestamp) need
+    # fixing. The dates are stored as "YYYY-MM-DD hh:mm:ss.fffffffZ", hence comparing
+    # the strings is the same as comparing the timestamps to 0.
+    where = (" WHERE `Path` IS NOT NULL AND `Path` != ''"
+             " AND (`DateCreated` < '1970' OR `DateModified` < '1970')")
     try:
+        rowcount = cur.execute("SELECT COUNT(*) FROM `BaseItems`" + where).fetchone()[0]
         query = "SELECT `rowid`, `Path`, `DateCreated`, `DateModified` FROM `BaseItems`"
-        rows = [r for r in cur.execute(query)]
+        rows = cur.execute(query + where)
     except sqlite3.OperationalError:
         print_log("Error reading BaseItems. Checking table name...")
         return
 
+    updates = []
     progress = 0
-    rowcount = len(rows)
     t = time()
 
     for rowid, target, date_created, date_modified in rows:
@@ -1253,40 +1595,32 @@ def update_file_dates():
             print_log(f"Progress: {progress} / {rowcount} rows")
             t = time()
 
-        if not target:
-            continue
-
         target, idgaf1, idgaf2 = recursive_root_path_replacer(target, to_replace=fs_path_replacements)
-        target = Path(target)
-        if not target.is_absolute():
-            if target.is_relative_to("/"):
-                target = target.relative_to("/")
-            target = target_root / target
-
-        if not target.exists():
-            continue
+        target = below_target_root(target)
 
         date_created_ns  = jf_date_str_to_python_ns(date_created)
         date_modified_ns = jf_date_str_to_python_ns(date_modified)
 
-        if date_created_ns >= 0 and date_modified_ns >= 0:
-            continue
-
+        # A missing file raises here, no need for a separate exists() check (which would
+        # stat the file a second time).
         try:
             filestats = os.stat(target)
         except OSError:
             continue
 
-        # FIX: Changed TypedBaseItems -> BaseItems in UPDATE statements
+        # None keeps the current value (see the COALESCE below).
+        new_date_created = None
+        new_date_modified = None
         if date_created_ns < 0:
             new_date_created = get_datestr_from_python_time_ns(filestats.st_ctime_ns)
-            cur.execute("UPDATE `BaseItems` SET `DateCreated` = ? WHERE `rowid` = ?",
-                        (new_date_created, rowid))
         if date_modified_ns < 0:
             new_date_modified = get_datestr_from_python_time_ns(filestats.st_mtime_ns)
-            cur.execute("UPDATE `BaseItems` SET `DateModified` = ? WHERE `rowid` = ?",
-                        (new_date_modified, rowid))
+        updates.append((new_date_created, new_date_modified, rowid))
 
+    # FIX: Changed TypedBaseItems -> BaseItems in UPDATE statements
+    # One prepared statement for all rows, both dates at once.
+    cur.executemany("UPDATE `BaseItems` SET `DateCreated` = COALESCE(?, `DateCreated`), "
+                    "`DateModified` = COALESCE(?, `DateModified`) WHERE `rowid` = ?", updates)
     con.commit()
     print_log("Done.")
 
@@ -1300,9 +1634,16 @@ def load_state():
 
 def save_state(completed_step):
     current_state = load_state()
+    if completed_step in current_state:
+        # Nothing new to remember.
+        return
     current_state.add(completed_step)
-    with open(STATE_FILE, 'w') as f:
-        json.dump(list(current_state), f)
+    # Write to a temporary file first and replace the state file with it. A crash while
+    # writing can then only lose the new step, not leave an empty or truncated state file.
+    tmp_file = STATE_FILE + ".tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(sorted(current_state), f)
+    os.replace(tmp_file, STATE_FILE)
 
 def reset_state():
     if os.path.exists(STATE_FILE):
@@ -1315,20 +1656,63 @@ def check_disk_space(src_root: Path, tgt_root: Path):
 
     print_log("Checking disk space requirements...")
 
-    def get_tree_size(path):
-        total_size = 0
+    # Lists one folder. Returns the total size of the files within and the paths of its subfolders.
+    # os.scandir provides the file type with the directory listing, so unlike Path.rglob + is_file
+    # + stat, only the files themselves are stat'ed. Like rglob, symlinked folders aren't entered.
+    def scan_folder(folder):
+        size = 0
+        subfolders = []
         try:
-            for p in path.rglob('*'):
-                if p.is_file():
-                    total_size += p.stat().st_size
+            with os.scandir(folder) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        subfolders.append(entry.path)
+                    elif entry.is_file():
+                        size += entry.stat().st_size
         except OSError:
+            # Unreadable folder (or a file vanished in the meantime). Skip it and count the rest.
             pass
+        return size, subfolders
+
+    # Sums up the sizes of all files below path. The tree is processed level by level, all
+    # folders of a level in parallel: the time goes into waiting for the file system (especially
+    # on network shares and HDDs), which threads can overlap.
+    def get_tree_size(path):
+        total_size = 0
+        folders = [path]
+        with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as pool:
+            while folders:
+                results = list(pool.map(scan_folder, folders))
+                folders = []
+                for size, subfolders in results:
+                    total_size += size
+                    folders.extend(subfolders)
         return total_size
 
     if not src_root.exists():
         print_log(f"Error: Source root {src_root} does not exist.")
         sys.exit(1)
 
+    # The free space is checked on the closest existing folder of tgt_root. Unlike walking up
+    # with .parent, this also ends if not even the anchor exists (f.ex. a missing drive);
+    # disk_usage reports that error then instead of looping forever.
+    for check_path in (tgt_root, *tgt_root.parents):
+        if check_path.exists():
+            break
+
+    total, used, free = shutil.disk_usage(check_path)
+
+    # Quick check first: the source can't be larger than everything stored on its file system
+    # (apart from special cases like mount points within the source or compressed file systems).
+    # If even that fits, walking the whole source tree isn't necessary.
+    src_fs_used = shutil.disk_usage(src_root).used
+    if free >= src_fs_used + (src_fs_used * 0.10) + (500 * 1024 * 1024):
+        print_log(f"Available space ({free / (1024**3):.2f} GB) exceeds the used space of the source "
+                  f"file system ({src_fs_used / (1024**3):.2f} GB) plus safety buffer.")
+        print_log("Disk space check passed.")
+        print_log("")
+        return
+
     print_log("Calculating source size...", end=" ")
     src_size = get_tree_size(src_root)
     print_log(f"{src_size / (1024**3):.2f} GB")
@@ -1344,12 +1728,6 @@ def check_disk_space(src_root: Path, tgt_root: Path):
     safety_buffer = (remaining_size * 0.10) + (500 * 1024 * 1024)
     required_space = remaining_size + safety_buffer
 
-    check_path = tgt_root
-    while not check_path.exists():
-        check_path = check_path.parent
-
-    total, used, free = shutil.disk_usage(check_path)
-
     print_log(f"------------------------------------------------")
     print_log(f"Est. Remaining Data to Copy: {remaining_size / (1024**3):.2f} GB")
     print_log(f"Safety Buffer:               {safety_buffer / (1024**3):.2f} GB")